@@ -360,6 +360,7 @@ def get_mmc4_dataset(args, image_processor, tokenizer, epoch=0, floor=False):
         shuffle=False,
         num_workers=args.workers,
         persistent_workers=True,
+        pin_memory=True,
     )
 
     # add meta-data to dataloader instance for convenience
@@ -462,6 +463,7 @@ def get_laion_dataset(args, image_processor, tokenizer, epoch=0, floor=False):
         shuffle=False,
         num_workers=args.workers,
         persistent_workers=True,
+        pin_memory=True,
     )
 
     # add meta-data to dataloader instance for convenience
@@ -1,7 +1,6 @@
 """ Main training script """
 
 import argparse
-import glob
 import os
 import random
 
@@ -11,11 +10,15 @@ import wandb
 from data import get_data
 from distributed import init_distributed_device, world_info_from_env
 from torch.nn.parallel import DistributedDataParallel as DDP
+from torch.distributed.algorithms.ddp_comm_hooks import default_hooks
+from torch.distributed.algorithms.ddp_comm_hooks import powerSGD_hook as powerSGD
+from torch.distributed.optim import ZeroRedundancyOptimizer
 from torch.distributed.fsdp import FullyShardedDataParallel as FSDP
 from train_utils import (
     train_one_epoch,
     get_mp_policy_dtype,
     save_checkpoint,
+    wait_for_checkpoint,
 )
 from transformers import (
     get_constant_schedule_with_warmup,
@@ -42,6 +45,45 @@ import functools
 from open_flamingo import create_model_and_transforms
 
 
+# substrings of xattn parameter names that should not be weight decayed;
+# "ff.0." is the LayerNorm at the start of the FeedForward nn.Sequential
+_NO_WEIGHT_DECAY_KEYS = ("ff_gate", "attn_gate", "norm", "bias", "ff.0.")
+
+
+def apply_decay(name):
+    """
+    Weight decay is only applied to the gated cross-attention weights,
+    excluding the tanh gates, layer norms and biases.
+    This is decided by name, since FSDP flattens the parameters and loses their shapes.
+    """
+    name = name.replace("_checkpoint_wrapped_module.", "").replace(
+        "_fsdp_wrapped_module.", ""
+    )
+    return "gated_cross_attn_layer" in name and not any(
+        k in name for k in _NO_WEIGHT_DECAY_KEYS
+    )
+
+
+def find_latest_checkpoint(run_name):
+    """
+    Return the path of the checkpoint_{epoch}.pt file with the highest epoch in run_name,
+    or None if there is none. Lists the directory once, which keeps this cheap on network filesystems.
+    """
+    latest_epoch, latest_path = -1, None
+    try:
+        with os.scandir(run_name) as entries:
+            for entry in entries:
+                name = entry.name
+                if not (name.startswith("checkpoint_") and name.endswith(".pt")):
+                    continue
+                epoch = name[len("checkpoint_") : -len(".pt")]
+                if epoch.isdigit() and int(epoch) > latest_epoch:
+                    latest_epoch, latest_path = int(epoch), entry.path
+    except FileNotFoundError:
+        pass
+    return latest_path
+
+
 def random_seed(seed=42, rank=0):
     torch.manual_seed(seed + rank)
     np.random.seed(seed + rank)
@@ -103,14 +145,24 @@ def main():
     parser.add_argument(
         "--precision",
         choices=["amp_bf16", "amp_bfloat16", "bf16", "fp16", "fp32"],
-        default="fp32",
-        help="Floating point precision.",
+        # bf16 autocast needs hardware support (Ampere or newer)
+        default=(
+            "amp_bf16"
+            if torch.cuda.is_available() and torch.cuda.is_bf16_supported()
+            else "fp32"
+        ),
+        help="Floating point precision. Defaults to amp_bf16 if the GPU supports bf16, otherwise fp32.",
     )
     parser.add_argument(
         "--gradient_checkpointing",
         action="store_true",
         help="whether to train with gradient/activation checkpointing",
     )
+    parser.add_argument(
+        "--compile",
+        action="store_true",
+        help="whether to compile the model with torch.compile",
+    )
     parser.add_argument(
         "--num_epochs",
         type=int,
@@ -198,6 +250,18 @@ def main():
     parser.add_argument(
         "--fsdp_sharding_strategy", default="full", type=str, choices=["full", "hybrid"]
     )
+    parser.add_argument(
+        "--ddp_powersgd_rank",
+        default=0,
+        type=int,
+        help="If > 0, compress DDP gradient communication with PowerSGD at this rank instead of casting gradients to the training precision.",
+    )
+    parser.add_argument(
+        "--shard_optimizer_state",
+        default=False,
+        action="store_true",
+        help="Shard the optimizer state across ranks with ZeroRedundancyOptimizer (ZeRO-1). Not compatible with FSDP, which already shards it.",
+    )
 
     # wandb args
     parser.add_argument("--report_to_wandb", default=False, action="store_true")
@@ -228,6 +292,12 @@ def main():
     if args.save_checkpoints_to_wandb and not args.report_to_wandb:
         raise ValueError("save_checkpoints_to_wandb requires report_to_wandb")
 
+    if args.compile and args.fsdp and not args.fsdp_use_orig_params:
+        raise ValueError("compile with fsdp requires fsdp_use_orig_params")
+
+    if args.fsdp and args.shard_optimizer_state:
+        raise ValueError("shard_optimizer_state is not compatible with fsdp")
+
     if args.fsdp and not args.fsdp_use_orig_params:
         print(
             "Warning: FSDP is running without fsdp_use_orig_params flag. "
@@ -256,6 +326,11 @@ def main():
     device_id = init_distributed_device(args)
     random_seed(args.seed)
 
+    # allow TF32 for the matmuls / convolutions that run outside of autocast
+    torch.backends.cuda.matmul.allow_tf32 = True
+    torch.backends.cudnn.allow_tf32 = True
+    torch.backends.cudnn.benchmark = True
+
     # Initialize model
     model, image_processor, tokenizer = create_model_and_transforms(
         args.vision_encoder_path,
@@ -280,16 +355,14 @@ def main():
         )
 
     # Load model checkpoint on CPU
-    if os.path.exists(f"{args.run_name}") and args.resume_from_checkpoint is None:
+    if args.resume_from_checkpoint is None:
         # if args do not specify a checkpoint to resume from, check if checkpoints exist for this run
         # and automatically resume from the latest checkpoint
-        checkpoint_list = glob.glob(f"{args.run_name}/checkpoint_*.pt")
-        if len(checkpoint_list) == 0:
+        latest_checkpoint = find_latest_checkpoint(args.run_name)
+        if latest_checkpoint is None:
             print(f"Found no checkpoints for run {args.run_name}.")
         else:
-            args.resume_from_checkpoint = sorted(
-                checkpoint_list, key=lambda x: int(x.split("_")[-1].split(".")[0])
-            )[-1]
+            args.resume_from_checkpoint = latest_checkpoint
             print(
                 f"Found checkpoint {args.resume_from_checkpoint} for run {args.run_name}."
             )
@@ -299,13 +372,15 @@ def main():
         if args.rank == 0:
             print(f"Loading checkpoint from {args.resume_from_checkpoint}")
         checkpoint = torch.load(args.resume_from_checkpoint, map_location="cpu")
-        msd = checkpoint["model_state_dict"]
+        # pop each state dict as it is consumed so its host memory is released early
+        msd = checkpoint.pop("model_state_dict")
         msd = {k.replace("module.", ""): v for k, v in msd.items()}
         resume_from_epoch = checkpoint["epoch"] + 1
 
         # for fsdp, only one rank needs to load the state dict
         if not args.fsdp or args.rank == 0:
             model.load_state_dict(msd, False)
+        del msd
 
     # Initialize FSDP / DDP, and ensure the model is on GPU
     print(f"Initializing distributed training with {args.world_size} GPUs.")
@@ -365,7 +440,27 @@ def main():
 
     else:
         model = model.to(device_id)
-        ddp_model = DDP(model, device_ids=[device_id])
+        # the ViT patch embedding conv runs faster in channels_last with autocast
+        model.vision_encoder.to(memory_format=torch.channels_last)
+        ddp_model = DDP(
+            model,
+            device_ids=[device_id],
+            bucket_cap_mb=64,  # fewer, larger all-reduces than the 25MB default
+            gradient_as_bucket_view=True,  # grads alias the buckets, saving a copy
+            broadcast_buffers=False,  # the model has no buffers that change in training
+        )
+
+        # as with the FSDP reduce_dtype, keep fp32 params / optimizer state but communicate compressed grads
+        if args.ddp_powersgd_rank > 0:
+            powersgd_state = powerSGD.PowerSGDState(
+                process_group=None,
+                matrix_approximation_rank=args.ddp_powersgd_rank,
+            )
+            ddp_model.register_comm_hook(powersgd_state, powerSGD.powerSGD_hook)
+        elif get_mp_policy_dtype(args.precision) == torch.bfloat16:
+            ddp_model.register_comm_hook(None, default_hooks.bf16_compress_hook)
+        elif get_mp_policy_dtype(args.precision) == torch.float16:
+            ddp_model.register_comm_hook(None, default_hooks.fp16_compress_hook)
 
     # Initialize gradient checkpointing
     if args.gradient_checkpointing:
@@ -382,7 +477,15 @@ def main():
             and not isinstance(m, CheckpointWrapper),
         )
 
+    # Compile the model; keep ddp_model uncompiled for checkpointing so state dict keys are unchanged
+    # LAION captions are padded to the longest in the batch, so sequence lengths vary between steps:
+    # compile with dynamic shapes (torch 2.0 defaults to static shapes, which would recompile for
+    # every new length) and use the default mode rather than CUDA graphs
+    train_model = torch.compile(ddp_model, dynamic=True) if args.compile else ddp_model
+
     # Initialize optimizer
+    # Note: the optimizer is stepped after backward rather than inside it, since each step
+    # accumulates gradients over two backward passes (LAION + MMC4) and clips the global grad norm
     params_to_optimize = ddp_model.named_parameters()
     params_to_optimize = list(
         filter(
@@ -391,37 +494,70 @@ def main():
             params_to_optimize,
         )
     )
+    # the fused AdamW kernel updates all params in a single launch, but requires CUDA params
+    use_fused_adamw = device_id.type == "cuda"
     if not args.fsdp or args.fsdp_use_orig_params:
         # apply weight decay only to params in the xattn layers
         def get_grouped_params(model):
             params_with_wd, params_without_wd = [], []
             for n, p in params_to_optimize:
-                if "gated_cross_attn" in n:
+                if apply_decay(n):
                     params_with_wd.append(p)
                 else:
                     params_without_wd.append(p)
+            if args.rank == 0:
+                print(
+                    f"Optimizing {sum(p.numel() for p in params_with_wd)} parameters with weight decay "
+                    + f"and {sum(p.numel() for p in params_without_wd)} parameters without weight decay"
+                )
             return [
                 {"params": params_with_wd, "weight_decay": args.weight_decay},
                 {"params": params_without_wd, "weight_decay": 0.0},
             ]
 
-        optimizer = torch.optim.AdamW(
-            get_grouped_params(params_to_optimize), lr=args.learning_rate
-        )
+        if args.shard_optimizer_state:
+            optimizer = ZeroRedundancyOptimizer(
+                get_grouped_params(params_to_optimize),
+                optimizer_class=torch.optim.AdamW,
+                lr=args.learning_rate,
+                fused=use_fused_adamw,
+            )
+        else:
+            optimizer = torch.optim.AdamW(
+                get_grouped_params(params_to_optimize),
+                lr=args.learning_rate,
+                fused=use_fused_adamw,
+            )
     else:
         # unclear if we should be using no weight decay or small weight decay for all parameters
         optimizer = torch.optim.AdamW(
             (p for _, p in params_to_optimize),
             lr=args.learning_rate,
             weight_decay=args.weight_decay,
+            fused=use_fused_adamw,
         )
 
     # load optimizer checkpoint
     if args.resume_from_checkpoint is not None:
-        osd = checkpoint["optimizer_state_dict"]
+        osd = checkpoint.pop("optimizer_state_dict")
         if args.fsdp:
             osd = FSDP.optim_state_dict_to_load(osd, ddp_model, optimizer)
         optimizer.load_state_dict(osd)
+        del osd
+        if use_fused_adamw:
+            # checkpoints saved without fused AdamW store fused=None, which would override it
+            for group in optimizer.param_groups:
+                group["fused"] = True
+            # torch 2.0 loads the "step" state on CPU (ZeroRedundancyOptimizer also forces it there),
+            # but fused AdamW needs it on the param device
+            optimizer_states = [optimizer.state]
+            if isinstance(optimizer, ZeroRedundancyOptimizer):
+                # the local shard's optimizer is the one that actually steps
+                optimizer_states.append(optimizer.optim.state)
+            for optimizer_state in optimizer_states:
+                for p, state in optimizer_state.items():
+                    if "step" in state:
+                        state["step"] = state["step"].to(p.device)
 
     # Initialize data loaders
     laion_dataset = get_data(args, image_processor, tokenizer, "image_text")
@@ -454,6 +590,7 @@ def main():
     # load lr scheduler checkpoint
     if args.resume_from_checkpoint is not None:
         lr_scheduler.load_state_dict(checkpoint["lr_scheduler_state_dict"])
+        del checkpoint
 
     # Start training!
     ddp_model.train()
@@ -466,7 +603,7 @@ def main():
 
         train_one_epoch(
             args=args,
-            model=ddp_model,
+            model=train_model,
             epoch=epoch,
             tokenizer=tokenizer,
             optimizer=optimizer,
@@ -480,6 +617,7 @@ def main():
 
     # save final checkpoint
     save_checkpoint(ddp_model, optimizer, lr_scheduler, epoch, args)
+    wait_for_checkpoint()
 
 
 if __name__ == "__main__":
@@ -1,4 +1,5 @@
 import time
+from concurrent.futures import ThreadPoolExecutor
 from contextlib import suppress
 import torch
 from tqdm import tqdm
@@ -8,10 +9,15 @@ from torch.distributed.fsdp import (
     StateDictType,
 )
 from torch.distributed.fsdp.api import FullOptimStateDictConfig
+from torch.distributed.optim import ZeroRedundancyOptimizer
 import os
 import wandb
 from einops import rearrange
 
+# checkpoints are written to disk by a background thread on rank 0
+_checkpoint_executor = ThreadPoolExecutor(max_workers=1)
+_checkpoint_future = None
+
 
 def get_cast_dtype(precision: str):
     cast_dtype = None
@@ -43,6 +49,57 @@ def get_autocast(precision, cache_enabled=True):
         return suppress
 
 
+def to_channels_last(images):
+    """
+    Convert a batch of images of shape (..., C, H, W) to channels_last memory format.
+    The leading dims are flattened for the conversion and then restored as a view, so the
+    layout survives the reshape to (B * T_img * F, C, H, W) in front of the vision encoder.
+    """
+    return (
+        images.flatten(0, -4)
+        .contiguous(memory_format=torch.channels_last)
+        .view(images.shape)
+    )
+
+
+class CUDAPrefetcher:
+    """
+    Wraps a dataloader and copies the images of the next batch to the GPU on a side stream,
+    so that the host-to-device copy overlaps with the current training step.
+    Only the images (the first element of each batch) are moved; the text stays on the host,
+    where the labels are built.
+    """
+
+    def __init__(self, loader, device):
+        self.loader = loader
+        self.device = device
+        self.stream = torch.cuda.Stream(device) if device.type == "cuda" else None
+
+    def __iter__(self):
+        if self.stream is None:
+            yield from self.loader
+            return
+
+        loader_iter = iter(self.loader)
+        next_batch = self._preload(loader_iter)
+        while next_batch is not None:
+            current_stream = torch.cuda.current_stream(self.device)
+            current_stream.wait_stream(self.stream)
+            batch = next_batch
+            # the images were allocated on the side stream but are consumed on this one
+            batch[0].record_stream(current_stream)
+            next_batch = self._preload(loader_iter)
+            yield batch
+
+    def _preload(self, loader_iter):
+        batch = next(loader_iter, None)
+        if batch is None:
+            return None
+        with torch.cuda.stream(self.stream):
+            images = batch[0].to(self.device, non_blocking=True)
+        return (images, *batch[1:])
+
+
 def train_one_epoch(
     args,
     model,
@@ -83,16 +140,32 @@ def train_one_epoch(
 
     # loop through dataloader
     for num_steps, (batch_laion, batch_mmc4) in tqdm(
-        enumerate(zip(laion_loader, mmc4_loader)),
+        enumerate(
+            zip(
+                CUDAPrefetcher(laion_loader, device_id),
+                CUDAPrefetcher(mmc4_loader, device_id),
+            )
+        ),
         disable=args.rank != 0,
         total=total_training_steps,
         initial=(epoch * num_batches_per_epoch),
     ):
         data_time_m.update(time.time() - end)
         global_step = num_steps + epoch * num_batches_per_epoch
+        is_accumulation_boundary = (
+            ((num_steps + 1) % args.gradient_accumulation_steps) == 0
+        ) or (num_steps == num_batches_per_epoch - 1)
+
+        # with DDP, only all-reduce gradients on the last backward pass before an optimizer step
+        if args.fsdp:
+            laion_sync_context = mmc4_sync_context = suppress
+        else:
+            laion_sync_context = model.no_sync
+            mmc4_sync_context = suppress if is_accumulation_boundary else model.no_sync
 
         #### LAION FORWARD PASS ####
         images = batch_laion[0].to(device_id, dtype=cast_dtype, non_blocking=True)
+        images = to_channels_last(images)
         images = rearrange(images, "(b t f) c h w -> b t f c h w", t=1, f=1)
         input_ids = batch_laion[1][0].to(device_id, dtype=cast_dtype, non_blocking=True)
         attention_mask = batch_laion[1][1].to(
@@ -103,22 +176,24 @@ def train_one_epoch(
         labels = input_ids.clone()
         labels[labels == tokenizer.pad_token_id] = -100
         labels[labels == media_token_id] = -100
-        labels = labels.to(device_id)
+        labels = labels.to(device_id, non_blocking=True)
 
         # gradient accumulation w/ fsdp cpu offloading requires a no_sync context manager
-        with autocast():
-            loss_laion = model(
-                vision_x=images,
-                lang_x=input_ids,
-                attention_mask=attention_mask,
-                labels=labels,
-            )[0]
-
-        divided_loss_laion = loss_laion / args.gradient_accumulation_steps
-        (divided_loss_laion * args.loss_multiplier_laion).backward()
+        with laion_sync_context():
+            with autocast():
+                loss_laion = model(
+                    vision_x=images,
+                    lang_x=input_ids,
+                    attention_mask=attention_mask,
+                    labels=labels,
+                )[0]
+
+            divided_loss_laion = loss_laion / args.gradient_accumulation_steps
+            (divided_loss_laion * args.loss_multiplier_laion).backward()
 
         #### MMC4 FORWARD PASS ####
         images = batch_mmc4[0].to(device_id, dtype=cast_dtype, non_blocking=True)
+        images = to_channels_last(images)
         images = rearrange(images, "b (t f) c h w -> b t f c h w", f=1)
         input_ids = torch.stack([x[0] for x in batch_mmc4[1]]).squeeze(1)
         attention_mask = torch.stack([x[1] for x in batch_mmc4[1]]).squeeze(1)
@@ -147,29 +222,30 @@ def train_one_epoch(
                     token_idx += 1
 
         labels[labels == media_token_id] = -100
-        labels = labels.to(device_id)
+        labels = labels.to(device_id, non_blocking=True)
 
         # gradient accumulation w/ fsdp cpu offloading requires a no_sync context manager
-        with autocast():
-            loss_mmc4 = model(
-                vision_x=images,
-                lang_x=input_ids.to(device_id),
-                attention_mask=attention_mask.to(device_id),
-                labels=labels,
-            )[0]
-
-            # if loss is nan, skip this batch
-            # this hack of skipping the batch is not FSDP-compatible
-            if torch.isnan(loss_mmc4):
-                print("loss is nan, skipping this batch")
-                print("input_ids: ", tokenizer.batch_decode(input_ids))
-                print("labels: ", labels)
-                print("images: ", images)
-                optimizer.zero_grad(set_to_none=True)
-                continue
-
-        divided_loss_mmc4 = loss_mmc4 / args.gradient_accumulation_steps
-        (divided_loss_mmc4 * args.loss_multiplier_mmc4).backward()
+        with mmc4_sync_context():
+            with autocast():
+                loss_mmc4 = model(
+                    vision_x=images,
+                    lang_x=input_ids.to(device_id, non_blocking=True),
+                    attention_mask=attention_mask.to(device_id, non_blocking=True),
+                    labels=labels,
+                )[0]
+
+                # if loss is nan, skip this batch
+                # this hack of skipping the batch is not FSDP-compatible
+                if torch.isnan(loss_mmc4):
+                    print("loss is nan, skipping this batch")
+                    print("input_ids: ", tokenizer.batch_decode(input_ids))
+                    print("labels: ", labels)
+                    print("images: ", images)
+                    optimizer.zero_grad(set_to_none=True)
+                    continue
+
+            divided_loss_mmc4 = loss_mmc4 / args.gradient_accumulation_steps
+            (divided_loss_mmc4 * args.loss_multiplier_mmc4).backward()
 
         if (not args.freeze_lm_embeddings) and (
             not args.fsdp or args.fsdp_use_orig_params
@@ -186,31 +262,24 @@ def train_one_epoch(
             zero_mask[endofchunk_token_id] = torch.ones_like(
                 zero_mask[endofchunk_token_id]
             )
+            # mask in-place so that DDP's gradient bucket views stay intact
+            embed_grad.mul_(zero_mask)
+
+        # step optimizer and log
+        if is_accumulation_boundary:
+            # clip gradient norm once per optimizer step, on the fully accumulated gradients
+            # (for both DDP and FSDP; with DDP, gradients are only synced across ranks on this step)
             if args.fsdp:
-                model.lang_encoder.get_input_embeddings().weight.grad = (
-                    embed_grad * zero_mask
-                )
+                """
+                The way we clip gradients with FSDP is different than the non-FSDP case,
+                because during FSDP, gradient norms are computed over certain submodules,
+                rather than the entire model.
+                At least for OPT-125M, this didn't seem to make a difference in performance.
+                """
+                model.clip_grad_norm_(1.0)
             else:
-                model.module.lang_encoder.get_input_embeddings().weight.grad = (
-                    embed_grad * zero_mask
-                )
-
-        # clip gradient norm
-        if args.fsdp:
-            """
-            The way we clip gradients with FSDP is different than the non-FSDP case,
-            because during FSDP, gradient norms are computed over certain submodules,
-            rather than the entire model.
-            At least for OPT-125M, this didn't seem to make a difference in performance.
-            """
-            model.clip_grad_norm_(1.0)
-        else:
-            torch.nn.utils.clip_grad_norm_(model.parameters(), 1.0)
+                torch.nn.utils.clip_grad_norm_(model.parameters(), 1.0)
 
-        # step optimizer and log
-        if (((num_steps + 1) % args.gradient_accumulation_steps) == 0) or (
-            num_steps == num_batches_per_epoch - 1
-        ):
             optimizer.step()
             lr_scheduler.step()
             optimizer.zero_grad(set_to_none=True)
@@ -333,10 +402,78 @@ def filter_state_dict_to_trainable(model, state_dict):
     return state_dict
 
 
+def _stage_to_cpu(obj, reuse_cpu_tensors=False, staged_tensors=None):
+    """
+    Recursively copy every tensor in obj to CPU, using pinned memory for CUDA tensors.
+    The copies are detached from training, which keeps updating the originals in-place.
+    Aliased tensors (e.g. tied input / output embeddings) are staged once and stay shared,
+    so torch.save still writes them once.
+    If reuse_cpu_tensors, non-scalar CPU tensors are assumed to already be detached copies
+    (as produced by FSDP's offload_to_cpu state dicts) and are not copied again.
+    """
+    if staged_tensors is None:
+        staged_tensors = {}
+    if isinstance(obj, torch.Tensor):
+        if reuse_cpu_tensors and not obj.is_cuda and obj.dim() > 0:
+            return obj
+        key = (obj.device, obj.data_ptr(), obj.dtype, obj.shape, obj.stride())
+        if key not in staged_tensors:
+            staged = torch.empty(
+                obj.shape, dtype=obj.dtype, device="cpu", pin_memory=obj.is_cuda
+            )
+            staged.copy_(obj, non_blocking=obj.is_cuda)
+            staged_tensors[key] = staged
+        return staged_tensors[key]
+    elif isinstance(obj, dict):
+        return {
+            k: _stage_to_cpu(v, reuse_cpu_tensors, staged_tensors)
+            for k, v in obj.items()
+        }
+    elif isinstance(obj, (list, tuple)):
+        return type(obj)(
+            _stage_to_cpu(v, reuse_cpu_tensors, staged_tensors) for v in obj
+        )
+    return obj
+
+
+def _write_checkpoint(checkpoint_dict, epoch, args):
+    """
+    Write a staged checkpoint to disk. Runs on the background checkpoint thread.
+    """
+    checkpoint_path = f"{args.run_name}/checkpoint_{epoch}.pt"
+    # write to a temporary file and atomically rename it, so a partially written file
+    # never looks like a checkpoint_{epoch}.pt that could be resumed from
+    tmp_checkpoint_path = f"{args.run_name}/checkpoint.tmp"
+    torch.save(checkpoint_dict, tmp_checkpoint_path)
+    os.replace(tmp_checkpoint_path, checkpoint_path)
+    if args.report_to_wandb and args.save_checkpoints_to_wandb:
+        wandb.save(checkpoint_path)
+
+    if args.delete_previous_checkpoint:
+        previous_checkpoint_path = f"{args.run_name}/checkpoint_{epoch-1}.pt"
+        if epoch > 0 and os.path.exists(previous_checkpoint_path):
+            os.remove(previous_checkpoint_path)
+
+
+def wait_for_checkpoint():
+    """
+    Block until the checkpoint currently being written (if any) is on disk.
+    Re-raises any exception from the background write.
+    """
+    global _checkpoint_future
+    if _checkpoint_future is not None:
+        _checkpoint_future.result()
+        _checkpoint_future = None
+
+
 def save_checkpoint(model, optimizer, lr_scheduler, epoch, args):
     """
     Save training checkpoint with model, optimizer, and lr_scheduler state.
+    On rank 0, the state is staged to CPU and written to disk in the background,
+    so training resumes as soon as the copy to host memory is done.
+    Call wait_for_checkpoint() before exiting to make sure the write has finished.
     """
+    global _checkpoint_future
     if args.fsdp:
         FSDP.set_state_dict_type(
             model,
@@ -349,7 +486,12 @@ def save_checkpoint(model, optimizer, lr_scheduler, epoch, args):
 
     else:
         model_state = model.state_dict()
-        optim_state = optimizer.state_dict()
+        if isinstance(optimizer, ZeroRedundancyOptimizer):
+            # gather the sharded optimizer state onto rank 0; must be called on all ranks
+            optimizer.consolidate_state_dict(to=0)
+            optim_state = optimizer.state_dict() if args.rank == 0 else None
+        else:
+            optim_state = optimizer.state_dict()
 
     if args.rank == 0:
         if not (args.fsdp and not args.fsdp_use_orig_params):
@@ -358,18 +500,26 @@ def save_checkpoint(model, optimizer, lr_scheduler, epoch, args):
         if not os.path.exists(args.run_name):
             os.makedirs(args.run_name)
 
-        checkpoint_dict = {
-            "epoch": epoch,
-            "model_state_dict": model_state,
-            "optimizer_state_dict": optim_state,
-            "lr_scheduler_state_dict": lr_scheduler.state_dict(),
-        }
+        # only keep one checkpoint in flight so we hold at most one staged copy in memory
+        wait_for_checkpoint()
+
+        staged_tensors = {}
+        checkpoint_dict = _stage_to_cpu(
+            {
+                "epoch": epoch,
+                "model_state_dict": model_state,
+                "optimizer_state_dict": optim_state,
+                "lr_scheduler_state_dict": lr_scheduler.state_dict(),
+            },
+            # FSDP state dicts are already offloaded to CPU copies
+            reuse_cpu_tensors=args.fsdp,
+            staged_tensors=staged_tensors,
+        )
+        # wait for the non_blocking device-to-host copies before handing off to the writer
+        if any(device.type == "cuda" for device, *_ in staged_tensors):
+            torch.cuda.current_stream().synchronize()
 
         print(f"Saving checkpoint to {args.run_name}/checkpoint_{epoch}.pt")
-        torch.save(checkpoint_dict, f"{args.run_name}/checkpoint_{epoch}.pt")
-        if args.report_to_wandb and args.save_checkpoints_to_wandb:
-            wandb.save(f"{args.run_name}/checkpoint_{epoch}.pt")
-
-        if args.delete_previous_checkpoint:
-            if epoch > 0:
-                os.remove(f"{args.run_name}/checkpoint_{epoch-1}.pt")
+        _checkpoint_future = _checkpoint_executor.submit(
+            _write_checkpoint, checkpoint_dict, epoch, args
+        )